@@ -14,7 +14,20 @@ default_settings = {
     "use_length_hiding_with_client": False,
     "padding_range_with_server": (0, 0),
     "padding_range_with_client": (0, 0),
-    "buffer_size": 1024,
+    "buffer_size": 16384,
+    "min_buffer_size": 4096,
+    "max_buffer_size": 65536,
+    "coalesce_size": 32768,
+    "expected_max_connections": 64,
+    "upstream_pool_size": 0,
+    "handshake_workers": None,
+    "so_rcvbuf": 0,
+    "so_sndbuf": 0,
+    "tcp_nodelay": True,
+    "tcp_quickack": False,
+    "transparent": False,
+    "processes": 1,
+    "stats_interval": 0,
     "verify_server_identity": False,
     "verify_client_identity": False,
     "suppress_exceptions": False
@@ -87,9 +100,53 @@ NONE:
         # the range of padding when talking to our clients, if use_length_hiding_with_client is True
         "padding_range_with_client": (0, 0),
 
-        # the size of the buffer
+        # the initial size of the buffer
         "buffer_size": 1024,
 
+        # the buffer of each direction is doubled or halved within these bounds
+        # depending on how much of it the last few reads filled
+        "min_buffer_size": 1024,
+        "max_buffer_size": 16384,
+
+        # records read back to back are gathered up to this size and sent together
+        # they are sent as soon as no more data is available, so this adds no latency
+        # the buffers don't grow past this size, as a batch would not use the rest
+        "coalesce_size": 32768,
+
+        # how many connections we expect at most, twice as many buffers are kept around for reuse
+        "expected_max_connections": 64,
+
+        # how many connections to the upstream server are made and handshaken in advance
+        # note that the upstream server may drop them if they stay idle for too long
+        "upstream_pool_size": 0,
+
+        # how many threads perform TLS handshakes, None for one per CPU
+        "handshake_workers": None,
+
+        # socket buffer sizes for both sides, 0 leaves them to the kernel's autotuning
+        # around 4 times max_buffer_size is enough to avoid a wakeup per read
+        "so_rcvbuf": 0,
+        "so_sndbuf": 0,
+
+        # send small records right away instead of waiting for more data
+        "tcp_nodelay": True,
+
+        # acknowledge received data right away (Linux only)
+        # quickack is a one-shot hint to the kernel, so it is re-armed after every read at the cost of two system calls
+        # in transparent mode it is only set once the connection is established
+        "tcp_quickack": False,
+
+        # pass the TLS records through untouched with splice(2) instead of terminating TLS
+        # length hiding and identity verification can't be used in this mode and are refused at startup
+        "transparent": False,
+
+        # how many processes accept connections for this instance, they share the port with SO_REUSEPORT
+        # use one per CPU to spread handshakes and forwarding over all of them despite the GIL
+        "processes": 1,
+
+        # report connection and byte counts to stderr every this many seconds, 0 to disable
+        "stats_interval": 0,
+
         # whether to verify upstream server's identity
         "verify_server_identity": False,
 
@@ -1,8 +1,16 @@
+import errno
+import os
+import socket
+
 from ctypes import *
+from ctypes.util import find_library
 from gnutls.library import libgnutls
-from gnutls.errors import GNUTLSError
 from gnutls.library.types import *
-from gnutls.library.errors import ErrorMessage
+from gnutls.library.constants import GNUTLS_E_AGAIN, GNUTLS_E_INTERRUPTED, GNUTLS_E_PUSH_ERROR
+from gnutls.library.functions import gnutls_transport_set_errno
+from gnutls.library.functions import gnutls_init, gnutls_deinit, gnutls_session_set_ptr, gnutls_transport_set_ptr
+from gnutls.library.functions import gnutls_priority_init, gnutls_priority_deinit, gnutls_priority_set
+from gnutls.library.functions import gnutls_handshake_set_private_extensions, gnutls_certificate_server_set_request
 from gnutls.connection import Session, ClientSession, ServerSession
 
 class GNUTLSRange(Structure):
@@ -12,28 +20,286 @@ gnutls_record_can_use_length_hiding = libgnutls.gnutls_record_can_use_length_hid
 gnutls_record_can_use_length_hiding.argtypes = [gnutls_session_t]
 gnutls_record_can_use_length_hiding.restype = c_int
 
-gnutls_record_send_range = libgnutls.gnutls_record_send_range
-gnutls_record_send_range.argtypes = [gnutls_session_t, c_void_p, size_t, POINTER(GNUTLSRange)]
-gnutls_record_send_range.restype = ssize_t
+# record functions without the errcheck python-gnutls attaches, for Pump
+record_recv = libgnutls['gnutls_record_recv']
+record_recv.argtypes = [gnutls_session_t, c_void_p, size_t]
+record_recv.restype = ssize_t
+
+record_send = libgnutls['gnutls_record_send']
+record_send.argtypes = [gnutls_session_t, c_void_p, size_t]
+record_send.restype = ssize_t
+
+record_send_range = libgnutls['gnutls_record_send_range']
+record_send_range.argtypes = [gnutls_session_t, c_void_p, size_t, POINTER(GNUTLSRange)]
+record_send_range.restype = ssize_t
+
+libc = CDLL(find_library('c'), use_errno=True)
+
+libc_send = libc.send
+libc_send.argtypes = [c_int, c_void_p, size_t, c_int]
+libc_send.restype = ssize_t
+
+class giovec_t(Structure):
+    _fields_ = [('iov_base', c_void_p), ('iov_len', size_t)]
+
+class msghdr(Structure):
+    _fields_ = [('msg_name', c_void_p), ('msg_namelen', c_uint),
+                ('msg_iov', POINTER(giovec_t)), ('msg_iovlen', size_t),
+                ('msg_control', c_void_p), ('msg_controllen', size_t),
+                ('msg_flags', c_int)]
+
+libc_sendmsg = libc.sendmsg
+libc_sendmsg.argtypes = [c_int, POINTER(msghdr), c_int]
+libc_sendmsg.restype = ssize_t
+
+gnutls_vec_push_func = CFUNCTYPE(ssize_t, gnutls_transport_ptr_t, POINTER(giovec_t), c_int)
+
+gnutls_transport_set_vec_push_function = libgnutls.gnutls_transport_set_vec_push_function
+gnutls_transport_set_vec_push_function.argtypes = [gnutls_session_t, gnutls_vec_push_func]
+gnutls_transport_set_vec_push_function.restype = None
+
+MSG_NOSIGNAL = getattr(socket, 'MSG_NOSIGNAL', 0x4000)
+
+libc_splice = libc.splice
+libc_splice.argtypes = [c_int, c_void_p, c_int, c_void_p, size_t, c_uint]
+libc_splice.restype = ssize_t
+
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+
+def buffer_slice(buffer, start, end):
+    # a zero-copy view of bytearray buffer[start:end] accepted by the sessions
+    return (c_char * (end - start)).from_buffer(buffer, start)
+
+class Priority(object):
+    # a priority string parsed once, instead of by every session using it
+    def __init__(self, priority_string):
+        if not isinstance(priority_string, bytes):
+            priority_string = priority_string.encode('ascii')
+        self._c_object = gnutls_priority_t()
+        gnutls_priority_init(byref(self._c_object), priority_string, None)
+
+    def __del__(self):
+        gnutls_priority_deinit(self._c_object)
 
 class LengthHidingSession(Session):
-    def send_range(self, data, padding_range):
-        range_ = GNUTLSRange()
-        data = str(data)
-        size = len(data)
-        while size > 0:
-            range_.low = size + padding_range[0]
-            range_.high = size + padding_range[1]
-            sent = gnutls_record_send_range(self._c_object, data[-size:], size, byref(range_))
+    def reset(self, sock, context, priority):
+        # a used gnutls session can't be rewound, so the wrapper gets a new
+        # one, set up like Session.__init__ does but with a parsed priority
+        gnutls_deinit(self._c_object)
+        # a null pointer, so a failing gnutls_init can't leave __del__ a freed one
+        self._c_object = gnutls_session_t()
+        self.__dict__.pop('write_queue', None)
+        self.__dict__.pop('_push_function', None)
+
+        gnutls_init(byref(self._c_object), self.session_type)
+        gnutls_session_set_ptr(self._c_object, id(self))
+        gnutls_priority_set(self._c_object, priority._c_object)
+        gnutls_transport_set_ptr(self._c_object, sock.fileno())
+        gnutls_handshake_set_private_extensions(self._c_object, 1)
+        self.socket = sock
+        self.credentials = context.credentials
+
+    def enable_write_queue(self):
+        # gnutls_record_send_range keeps retrying on EAGAIN instead of
+        # returning it, so on a non-blocking socket we accept every record
+        # and queue what the kernel does not take for flush_write_queue,
+        # the push is vectored so whatever gnutls has buffered goes out in
+        # one sendmsg without being joined first
+        self.write_queue = bytearray()
+        self._push_function = gnutls_vec_push_func(self._push)
+        gnutls_transport_set_vec_push_function(self._c_object, self._push_function)
+
+    def _push(self, transport, iov, iovcnt):
+        sent = 0
+
+        if not self.write_queue:
+            message = msghdr(msg_iov=iov, msg_iovlen=iovcnt)
+            sent = libc_sendmsg(self.socket.fileno(), byref(message), MSG_NOSIGNAL)
+
+            if sent < 0:
+                error = get_errno()
+                if error not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    gnutls_transport_set_errno(self._c_object, error)
+                    return -1
+                sent = 0
+
+        size = 0
+
+        for index in range(iovcnt):
+            length = iov[index].iov_len
+            size += length
+
+            if sent >= length:
+                sent -= length
+                continue
+
+            # appended straight from gnutls' buffer, without a string in between
+            self.write_queue += (c_char * (length - sent)).from_address(iov[index].iov_base + sent)
+            sent = 0
+
+        return size
+
+    def flush_write_queue(self):
+        # returns True once everything queued has been handed to the kernel
+        while self.write_queue:
+            size = len(self.write_queue)
+            sent = libc_send(self.socket.fileno(), buffer_slice(self.write_queue, 0, size), size, MSG_NOSIGNAL)
+
             if sent < 0:
-                raise GNUTLSError(ErrorMessage(sent))
-            size -= sent
+                error = get_errno()
+                if error in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False
+                if error != errno.EINTR:
+                    raise socket.error(error, os.strerror(error))
+                continue
+
+            del self.write_queue[:sent]
+
+        return True
 
     def can_use_length_hiding(self):
         return gnutls_record_can_use_length_hiding(self._c_object)
 
 class LengthHidingClientSession(ClientSession, LengthHidingSession):
-    pass
+    def reset(self, sock, context, priority, server_name=None):
+        LengthHidingSession.reset(self, sock, context, priority)
+        self._server_name = None
+        if server_name is not None:
+            self.server_name = server_name
 
 class LengthHidingServerSession(ServerSession, LengthHidingSession):
-    pass
+    def reset(self, sock, context, priority):
+        LengthHidingSession.reset(self, sock, context, priority)
+        if context.server_options.certificate_request is not None:
+            gnutls_certificate_server_set_request(self._c_object, context.server_options.certificate_request)
+
+PUMP_EOF = 0
+PUMP_BLOCKED = 1
+PUMP_RECV_FAILED = 2
+PUMP_SEND_FAILED = 3
+PUMP_PAUSED = 4
+
+class Pump(object):
+    # moves records from src to dst until either side would block or budget
+    # bytes were moved, talking to gnutls directly and reporting errors by
+    # status code
+    def __init__(self, src, dst, padding_range=None, coalesce_size=0, budget=0):
+        self.src = src
+        self.dst = dst
+        self.padding_range = padding_range
+        self.coalesce_size = coalesce_size
+        self.budget = budget
+        self.range = GNUTLSRange()
+        self.buffer = None
+        self.start = 0
+        self.end = 0
+        self.error = 0
+        self.full_reads = 0
+        self.short_reads = 0
+        self.received = 0
+
+    def pending(self):
+        return self.start < self.end
+
+    def run(self):
+        src = self.src._c_object
+        dst = self.dst._c_object
+        capacity = len(self.buffer)
+        address = addressof(buffer_slice(self.buffer, 0, capacity))
+        start = self.start
+        end = self.end
+        status = None
+        budget = self.budget
+        moved = 0
+
+        # records are read until this many bytes are gathered, the buffer
+        # is full or src runs dry, and then sent in one go
+        limit = min(self.coalesce_size, capacity) or capacity
+
+        padded = self.padding_range is not None
+
+        if padded:
+            range_ = self.range
+            range_ref = byref(range_)
+            padding_low, padding_high = self.padding_range
+            write_queue = self.dst.write_queue
+
+            # storing into the ctypes range is slow, and the range only changes
+            # with the size, which tends to repeat once reads are coalesced
+            range_size = -1
+
+        while True:
+            while start < end:
+                size = end - start
+
+                if padded:
+                    if size != range_size:
+                        low = size + padding_low
+                        range_.low = low if low > 0 else 1
+                        range_.high = size + padding_high
+                        range_size = size
+                    sent = record_send_range(dst, address + start, size, range_ref)
+                else:
+                    sent = record_send(dst, address + start, size)
+
+                if sent < 0:
+                    self.start, self.end = start, end
+                    if sent == GNUTLS_E_AGAIN or sent == GNUTLS_E_INTERRUPTED:
+                        return PUMP_BLOCKED
+                    self.error = sent
+                    return PUMP_SEND_FAILED
+
+                start += sent
+
+            start = end = 0
+            self.start = self.end = 0
+
+            # the queue only fills up when dst is congested, so the flush
+            # and its exception handling are skipped for the common case
+            if padded and write_queue:
+                try:
+                    if not self.dst.flush_write_queue():
+                        return PUMP_BLOCKED
+                except socket.error:
+                    self.error = GNUTLS_E_PUSH_ERROR
+                    return PUMP_SEND_FAILED
+
+            if status is not None:
+                return status
+
+            # src may still be readable, but others get their turn first
+            if budget and moved >= budget:
+                return PUMP_PAUSED
+
+            while end < limit:
+                received = record_recv(src, address + end, capacity - end)
+
+                if received > 0:
+                    end += received
+                elif received == 0:
+                    status = PUMP_EOF
+                    break
+                elif received == GNUTLS_E_AGAIN or received == GNUTLS_E_INTERRUPTED:
+                    status = PUMP_BLOCKED
+                    break
+                else:
+                    self.error = received
+                    return PUMP_RECV_FAILED
+
+            if end == 0:
+                return status
+
+            self.received += end
+            moved += end
+
+            # consecutive batches filling at least 90% or less than 25% of
+            # what a batch may hold, which is less than the buffer when coalescing
+            if end * 10 >= limit * 9:
+                self.full_reads += 1
+                self.short_reads = 0
+            elif end * 4 < limit:
+                self.short_reads += 1
+                self.full_reads = 0
+            else:
+                self.full_reads = self.short_reads = 0
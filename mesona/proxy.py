@@ -1,15 +1,32 @@
+from __future__ import print_function
+
+import collections
+import errno
+import fcntl
+import multiprocessing
+import os
+import select
 import signal
 import socket
-import SocketServer
 import sys
 import threading
 import traceback
 import time
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from ctypes import get_errno
 from gnutls.connection import TLSContext
-from gnutls.errors import GNUTLSError
+from gnutls.constants import SHUT_WR
+from gnutls.errors import OperationInterrupted, OperationWouldBlock
+from gnutls.library.errors import ErrorMessage
 
-from mesona.lengthhiding import LengthHidingClientSession, LengthHidingServerSession
+from mesona.lengthhiding import LengthHidingClientSession, LengthHidingServerSession, Priority, Pump
+from mesona.lengthhiding import PUMP_EOF, PUMP_RECV_FAILED, PUMP_SEND_FAILED, PUMP_PAUSED
+from mesona.lengthhiding import libc, libc_splice, SPLICE_F_MOVE, SPLICE_F_NONBLOCK
 
 class ReaderError(Exception):
     pass
@@ -17,162 +34,838 @@ class ReaderError(Exception):
 class WriterError(Exception):
     pass
 
-def connection_reader(src, buffer_size):
-    while True:
-        try:
-            data = src.recv(buffer_size)
-        except GNUTLSError as e:
-            raise ReaderError(e.message)
+def parse_address(address):
+    # returns (family, address) with the brackets around an IPv6 host removed,
+    # a host that is not an IPv6 literal is taken as IPv4 or a name
+    host = address[0]
 
-        if len(data) == 0:
-            return
+    if host.startswith('[') and host.endswith(']'):
+        host = host[1:-1]
 
-        yield data
+    try:
+        socket.inet_pton(socket.AF_INET6, host.split('%')[0])
+    except (socket.error, ValueError):
+        return socket.AF_INET, (host,) + tuple(address[1:])
 
-def send_range_safe(dst, data, range_low, range_high):
-    range_low = max(range_low, 1 - len(data))
-    range_high = range_high
+    return socket.AF_INET6, (host,) + tuple(address[1:])
+
+def peer_closed(sock):
+    try:
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+    except socket.error as e:
+        return e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+class BufferPool(object):
+    def __init__(self, size, count, min_size=None, max_size=None):
+        self.size = size
+        self.min_size = min_size or size
+        self.max_size = max_size or size
+        self.count = count
+        # only the reactor uses the pool, so there is nothing to lock
+        self.free = {size: collections.deque(bytearray(size) for _ in range(count))}
+
+    def acquire(self, size=None):
+        size = size or self.size
+
+        free = self.free.get(size)
+        if free:
+            return free.pop()
+
+        return bytearray(size)
+
+    def release(self, buffer):
+        free = self.free.setdefault(len(buffer), collections.deque())
+        if len(free) < self.count:
+            free.append(buffer)
+
+class WorkerPool(object):
+    def __init__(self, count):
+        self.tasks = queue.Queue()
+
+        for _ in range(count):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, function, *args):
+        self.tasks.put((function, args))
+
+    def work(self):
+        while True:
+            function, args = self.tasks.get()
+            function(*args)
 
-    dst.send_range(data, (range_low, range_high))
+class Counters(object):
+    # each thread counts into a bucket of its own without locking, and the
+    # buckets are only summed up when the totals are reported
+    def __init__(self):
+        self.local = threading.local()
+        self.buckets = []
 
-def forward_connection_with_padding(reader, dst, range_low, range_high):
-    for data in reader:
+    def add(self, name, value=1):
         try:
-            send_range_safe(dst, data, range_low, range_high)
-        except GNUTLSError as e:
-            raise WriterError(e.message)
+            bucket = self.local.bucket
+        except AttributeError:
+            bucket = self.local.bucket = collections.Counter()
+            self.buckets.append(bucket)
+
+        bucket[name] += value
+
+    def totals(self):
+        totals = collections.Counter()
+
+        for bucket in list(self.buckets):
+            # copying a dict is atomic, iterating one another thread writes is not
+            totals.update(dict(bucket))
+
+        return totals
+
+class LogWriter(object):
+    # writes to stderr from a thread of its own, so that the threads
+    # reporting errors never wait for the terminal or for each other
+    def __init__(self, size):
+        self.records = queue.Queue(size)
+
+        thread = threading.Thread(target=self.work)
+        thread.daemon = True
+        thread.start()
 
-def forward_connection(reader, dst):
-    for data in reader:
+    def write(self, record):
         try:
-            dst.send(data)
-        except GNUTLSError as e:
-            raise WriterError(e.message)
+            self.records.put_nowait(record)
+        except queue.Full:
+            # drop what doesn't fit during an error storm
+            pass
+
+    def work(self):
+        while True:
+            sys.stderr.write(self.records.get())
+
+class MITMServer(object):
+
+    address_family = socket.AF_INET
+
+    socket_type = socket.SOCK_STREAM
 
-def is_ipv6_address(address):
-    # an evil way to tell apart IPv6 addresses
-    ip_address = address[0]
-    return ip_address.startswith('[') and ip_address.endswith(']')
+    request_queue_size = 128
 
-class MITMServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
 
-    daemon_threads = True
+    poll_interval = 0.5
 
-    logging_lock = threading.Lock()
+    upstream_cache_timeout = 30
+
+    # cached upstreams are replaced this many seconds before they time out
+    upstream_refresh_margin = 5
+
+    upstream_retry_interval = 5
+
+    log_queue_size = 1024
 
     def __init__(self, config, bind_and_activate=True):
         self.config = config
 
-        if is_ipv6_address(config.listen_address):
-            self.address_family = socket.AF_INET6
+        if config.transparent and (config.use_length_hiding_with_server or config.use_length_hiding_with_client):
+            raise ValueError("Length hiding can't be used in transparent mode")
+
+        if config.transparent and (config.verify_server_identity or config.verify_client_identity):
+            raise ValueError("Identities can't be verified in transparent mode")
 
+        self.address_family, self.server_address = parse_address(config.listen_address)
         self.server_context = TLSContext(config.credentials_as_server, config.priority_string_as_server)
         self.client_context = TLSContext(config.credentials_as_client, config.priority_string_as_client)
+        self.server_priority = Priority(config.priority_string_as_server)
+        self.client_priority = Priority(config.priority_string_as_client)
 
-        SocketServer.ThreadingTCPServer.__init__(self, config.listen_address, MITMHandler, bind_and_activate)
+        # wrappers of closed sessions, reset and reused for new connections
+        self.server_sessions = collections.deque(maxlen=config.expected_max_connections)
+        self.client_sessions = collections.deque(maxlen=config.expected_max_connections)
 
-    def handle_error(self, request, client_address):
+        self.use_proxy = getattr(config, "proxy", None) is not None
+        self.upstream_address = self.resolve_server_address()
+
+        # pre-handshaken upstream sessions as (creation time, session)
+        # oldest on the left, where they are both taken and retired
+        self.upstream_cache = collections.deque()
+        self.upstream_cache_taken = threading.Event()
+
+        self.socket = socket.socket(self.address_family, self.socket_type)
+        self.epoll = select.epoll()
+
+        # what to call when an fd becomes ready
+        self.handlers = {}
+
+        buffer_size = min(max(config.buffer_size, config.min_buffer_size), config.max_buffer_size)
+        self.buffer_pool = BufferPool(buffer_size, 2 * config.expected_max_connections,
+                                      config.min_buffer_size, config.max_buffer_size)
+
+        # connections handed back to the reactor by the workers
+        self.ready_connections = queue.Queue()
+        self.waker = os.pipe()
+
+        # connections that stopped forwarding with data left to read
+        self.paused_connections = []
+        set_nonblocking(self.waker[0])
+        set_nonblocking(self.waker[1])
+
+        self.log = LogWriter(self.log_queue_size)
+        self.counters = Counters()
+        self.workers = WorkerPool(config.handshake_workers or multiprocessing.cpu_count())
+
+        self.accept_deferred = False
+        self.accept_failing = False
+
+        self.__is_shut_down = threading.Event()
+        self.__shutdown_request = False
+
+        if bind_and_activate:
+            try:
+                self.server_bind()
+                self.server_activate()
+            except:
+                self.server_close()
+                raise
+
+    def set_socket_options(self, sock):
+        if self.config.so_rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.config.so_rcvbuf)
+
+        if self.config.so_sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.config.so_sndbuf)
+
+        # records are batched by the pump, so don't let Nagle hold them back
+        if self.config.tcp_nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def set_quickack(self, sock):
+        if hasattr(socket, "TCP_QUICKACK"):
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+            except socket.error:
+                pass
+
+    def server_bind(self):
+        if self.allow_reuse_address:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        # every process gets a listening socket of its own on the same
+        # address, and the kernel spreads the connections across them
+        if self.config.processes > 1:
+            self.socket.setsockopt(socket.SOL_SOCKET, getattr(socket, "SO_REUSEPORT", 15), 1)
+
+        self.set_socket_options(self.socket)
+
+        self.socket.bind(self.server_address)
+
+        self.server_address = self.socket.getsockname()
+
+    def server_activate(self):
+        self.socket.listen(self.request_queue_size)
+        self.socket.setblocking(False)
+
+        self.register(self.socket.fileno(), self.accept_connections, select.EPOLLIN)
+        self.register(self.waker[0], self.collect_ready_connections, select.EPOLLIN)
+
+        if self.config.upstream_pool_size > 0 and not self.config.transparent:
+            thread = threading.Thread(target=self.keep_upstream_cache_warm)
+            thread.daemon = True
+            thread.start()
+
+        if self.config.stats_interval > 0:
+            thread = threading.Thread(target=self.report_stats)
+            thread.daemon = True
+            thread.start()
+
+    def server_close(self):
+        self.socket.close()
+        self.epoll.close()
+        os.close(self.waker[0])
+        os.close(self.waker[1])
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def serve_forever(self):
+        self.__is_shut_down.clear()
+
+        poll = self.epoll.poll
+        handlers = self.handlers
+
+        try:
+            while not self.__shutdown_request:
+                try:
+                    events = poll(0 if self.paused_connections else self.poll_interval)
+                except IOError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+
+                for fd, _ in events:
+                    handler = handlers.get(fd)
+                    if handler is not None:
+                        try:
+                            handler()
+                        except Exception:
+                            self.handler_failed(handler)
+
+                # the listener is edge-triggered, so connections left in the
+                # backlog when we ran out of fds have to be picked up by hand
+                if self.accept_deferred:
+                    self.accept_deferred = False
+                    self.accept_connections()
+
+                if self.paused_connections:
+                    self.resume_paused_connections()
+        finally:
+            self.__shutdown_request = False
+            self.__is_shut_down.set()
+
+    def shutdown(self):
+        self.__shutdown_request = True
+        self.__is_shut_down.wait()
+
+    def handler_failed(self, handler):
+        # one misbehaving connection must not take the reactor down with it
         self.print_exc()
 
-    def print_exc(self):
-        if self.config.suppress_exceptions:
-            return
+        connection = getattr(handler, "__self__", None)
 
-        with self.logging_lock:
-            print '-'*40
-            print 'Exception happened during processing of request'
-            traceback.print_exc()
-            print '-'*40
-
-class ForwardingThread(threading.Thread):
-    def __init__(self, src, dst, server):
-        threading.Thread.__init__(self)
-        self.daemon = True
-        self.src = src
-        self.dst = dst
-        self.server = server
+        if isinstance(connection, MITMConnection):
+            try:
+                connection.close()
+            except Exception:
+                self.print_exc()
+
+    def resume_paused_connections(self):
+        # their fds are edge-triggered and won't fire for the data that is
+        # already there, so they are carried on once the other events are done
+        paused, self.paused_connections = self.paused_connections, []
+
+        for connection in paused:
+            connection.resume_pending = False
+
+            try:
+                connection.handle_event()
+            except Exception:
+                self.handler_failed(connection.handle_event)
 
-    def run(self):
-        reader = connection_reader(self.src, self.server.config.buffer_size)
+    def accept_connections(self):
+        accept = self.socket.accept
+
+        while True:
+            try:
+                request, client_address = accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                if e.args[0] in (errno.EINTR, errno.ECONNABORTED):
+                    continue
+                if e.args[0] in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    # retried after the next poll, only reported once
+                    if not self.accept_failing:
+                        self.print_exc()
+                    self.accept_failing = True
+                    self.accept_deferred = True
+                    return
+                self.print_exc()
+                return
+
+            self.accept_failing = False
+
+            try:
+                connection = MITMConnection(request, client_address, self)
+            except Exception:
+                self.print_exc()
+                request.close()
+                continue
+
+            self.counters.add("accepted")
+            self.add_fd(request.fileno(), connection)
+            connection.schedule_setup()
+
+    def register(self, fd, handler, eventmask):
+        self.handlers[fd] = handler
+        self.epoll.register(fd, eventmask | select.EPOLLET)
+
+    def add_fd(self, fd, connection):
+        self.register(fd, connection.handle_event, select.EPOLLIN | select.EPOLLOUT)
+
+    def remove_fd(self, fd):
+        if self.handlers.pop(fd, None) is not None:
+            self.epoll.unregister(fd)
+
+    def hand_over(self, connection):
+        # called by the workers
+        self.ready_connections.put(connection)
 
         try:
-            if self.server.config.use_length_hiding_with_client:
-                forward_connection_with_padding(reader, self.dst, *self.server.config.padding_range_with_client)
-            else:
-                forward_connection(reader, self.dst)
-        except Exception:
-            self.server.print_exc()
+            os.write(self.waker[1], b'\0')
+        except OSError:
+            pass
+
+    def collect_ready_connections(self):
+        try:
+            while os.read(self.waker[0], 4096):
+                pass
+        except OSError:
+            pass
+
+        while True:
+            try:
+                connection = self.ready_connections.get_nowait()
+            except queue.Empty:
+                return
+
+            try:
+                connection.setup_stepped()
+            except Exception:
+                self.handler_failed(connection.setup_stepped)
+
+    def resolve_server_address(self):
+        # returns (family, address) for connect(), or None to let each new
+        # connection resolve it
+        family, server_address = parse_address(self.config.server_address)
+
+        if self.use_proxy:
+            # the proxy resolves names itself
+            return family, server_address
+
+        try:
+            family, _, _, _, address = socket.getaddrinfo(server_address[0], server_address[1], 0, socket.SOCK_STREAM)[0]
+        except socket.gaierror:
+            return None
+
+        return family, address
+
+    def create_server_socket(self):
+        # returns a socket for the upstream server and the address to connect it to
+        if self.use_proxy:
+            import socks
+            socket_builder = socks.socksocket
+        else:
+            socket_builder = socket.socket
+
+        if self.upstream_address is not None:
+            family, server_address = self.upstream_address
         else:
-            self.say_bye_to_dst()
+            family, server_address = parse_address(self.config.server_address)
+
+        sock = socket_builder(family, socket.SOCK_STREAM)
+
+        self.set_socket_options(sock)
+
+        if self.use_proxy:
+            proxy_type = socks.PROXY_TYPES[self.config.proxy[0]]
+            sock.set_proxy(proxy_type, *self.config.proxy[1:])
 
-        self.close_dst()
+        return sock, server_address
 
-    def say_bye_to_dst(self):
+    def new_server_session(self, sock):
         try:
-            self.dst.bye()
-        except:
-            pass
+            session = self.server_sessions.pop()
+        except IndexError:
+            return LengthHidingServerSession(sock, self.server_context)
+
+        session.reset(sock, self.server_context, self.server_priority)
+        return session
 
-    def close_dst(self):
+    def new_client_session(self, sock):
         try:
-            self.dst.shutdown()
+            session = self.client_sessions.pop()
+        except IndexError:
+            return LengthHidingClientSession(sock, self.client_context, self.config.server_name_indicator)
+
+        session.reset(sock, self.client_context, self.client_priority, self.config.server_name_indicator)
+        return session
+
+    def connect_to_server(self):
+        sock, server_address = self.create_server_socket()
+        remote = self.new_client_session(sock)
+
+        try:
+            remote.connect(server_address)
+            remote.handshake()
         except:
-            pass
+            remote.close()
+            self.client_sessions.append(remote)
+            raise
+
+        return remote
 
-        self.dst.close()
+    def take_cached_upstream(self):
+        while True:
+            try:
+                created, remote = self.upstream_cache.popleft()
+            except IndexError:
+                return None
 
-class MITMHandler(SocketServer.BaseRequestHandler):
-    def setup(self):
-        self.handshake_with_client()
+            self.upstream_cache_taken.set()
 
-        if self.server.config.verify_client_identity:
-            self.verify_client_identity()
+            if time.time() - created < self.upstream_cache_timeout and not peer_closed(remote.socket):
+                return remote
 
-        if self.server.config.use_length_hiding_with_client and not self.session.can_use_length_hiding():
-            raise RuntimeError("Can't use length hiding with client")
+            remote.close()
+            self.client_sessions.append(remote)
 
-        self.build_server_connection()
+    def keep_upstream_cache_warm(self):
+        # the pool is kept full, and the oldest entry is replaced shortly
+        # before it times out so that an idle pool never hands out stale ones
+        refresh_age = max(self.upstream_cache_timeout - self.upstream_refresh_margin, 0)
 
-        if self.server.config.verify_server_identity:
-            self.verify_server_identity()
+        while True:
+            now = time.time()
 
-        if self.server.config.use_length_hiding_with_server and not self.remote.can_use_length_hiding():
-            raise RuntimeError("Can't use length hiding with server")
+            try:
+                oldest = self.upstream_cache[0][0]
+            except IndexError:
+                oldest = now
 
-        self.start_forwarding_thread()
+            stale = now - oldest >= refresh_age
 
-    def handshake_with_client(self):
-        self.session = LengthHidingServerSession(self.request, self.server.server_context)
-        self.session.handshake()
+            if len(self.upstream_cache) >= self.config.upstream_pool_size and not stale:
+                self.upstream_cache_taken.wait(oldest + refresh_age - now)
+                self.upstream_cache_taken.clear()
+                continue
 
-    def build_server_connection(self):
-        server_address = self.server.config.server_address
-        use_proxy = hasattr(self.server.config, "proxy") and self.server.config.proxy is not None
-        is_ipv6 = is_ipv6_address(server_address)
+            try:
+                remote = self.connect_to_server()
+            except Exception:
+                self.print_exc()
+                time.sleep(self.upstream_retry_interval)
+                continue
 
-        if use_proxy:
-            import socks
-            socket_builder = socks.socksocket
+            self.upstream_cache.append((time.time(), remote))
+
+            if stale:
+                self.retire_cached_upstreams(refresh_age)
+
+    def retire_cached_upstreams(self, max_age):
+        now = time.time()
+
+        while True:
+            try:
+                created, remote = self.upstream_cache.popleft()
+            except IndexError:
+                return
+
+            if now - created < max_age:
+                self.upstream_cache.appendleft((created, remote))
+                return
+
+            remote.close()
+            self.client_sessions.append(remote)
+
+    def report_stats(self):
+        while True:
+            time.sleep(self.config.stats_interval)
+            totals = self.counters.totals()
+            self.log.write("{}: {} accepted, {} established, {} failed, {} bytes up, {} bytes down\n".format(
+                self.server_address, totals["accepted"], totals["established"], totals["failed"],
+                totals["bytes_up"], totals["bytes_down"]))
+
+    def handle_error(self, request, client_address):
+        self.print_exc()
+
+    def print_exc(self):
+        if self.config.suppress_exceptions:
+            return
+
+        self.log.write('{0}\nException happened during processing of request\n{1}{0}\n'.format(
+            '-'*40, traceback.format_exc()))
+
+class Forwarder(object):
+
+    # how many reads in a row have to (almost) fill the buffer, or leave
+    # most of it unused, before the buffer size is doubled or halved
+    resize_threshold = 4
+
+    # how many bytes are moved per event before other connections get a turn
+    budget = 262144
+
+    def __init__(self, src, dst, buffer_pool, counters, counter, padding_range=None, coalesce_size=0):
+        self.pump = Pump(src, dst, padding_range, coalesce_size, self.budget)
+        self.paused = False
+        self.buffer_pool = buffer_pool
+        self.buffer_size = buffer_pool.size
+        self.max_buffer_size = buffer_pool.max_size
+        self.counters = counters
+        self.counter = counter
+
+        # batches stop at coalesce_size anyway, so a larger buffer would go unused
+        if coalesce_size:
+            self.max_buffer_size = max(min(self.max_buffer_size, coalesce_size), buffer_pool.min_size)
+
+    def forward(self):
+        # returns True on EOF of src, False if src or dst would block or
+        # the budget is used up, which sets paused
+
+        # the buffer is only held while reading or while the data in it is pending
+        if self.pump.buffer is None:
+            self.pump.buffer = self.buffer_pool.acquire(self.buffer_size)
+
+        # run() reports failures by status, should it raise anyway the
+        # connection is closed and close() releases the buffer
+        status = self.pump.run()
+        self.paused = status == PUMP_PAUSED
+
+        # counted per run, so the reports include connections still open
+        if self.pump.received:
+            self.counters.add(self.counter, self.pump.received)
+            self.pump.received = 0
+
+        if not self.pump.pending():
+            self.release_buffer()
+
+        if status == PUMP_RECV_FAILED:
+            raise ReaderError(ErrorMessage(self.pump.error))
+
+        if status == PUMP_SEND_FAILED:
+            raise WriterError(ErrorMessage(self.pump.error))
+
+        return status == PUMP_EOF
+
+    def release_buffer(self):
+        self.pump.start = self.pump.end = 0
+
+        if self.pump.buffer is not None:
+            self.buffer_pool.release(self.pump.buffer)
+            self.pump.buffer = None
+
+        self.adapt_buffer_size()
+
+    def adapt_buffer_size(self):
+        pump = self.pump
+
+        if pump.full_reads >= self.resize_threshold:
+            if self.buffer_size < self.max_buffer_size:
+                self.buffer_size = min(self.buffer_size * 2, self.max_buffer_size)
+        elif pump.short_reads >= self.resize_threshold:
+            self.buffer_size = max(self.buffer_size // 2, self.buffer_pool.min_size)
         else:
-            socket_builder = socket.socket
+            return
+
+        pump.full_reads = pump.short_reads = 0
+
+class Splicer(object):
+    # moves bytes from src to dst through a pipe with splice(2), so in
+    # transparent mode they never reach user space
+    chunk_size = 65536
+
+    # how many bytes are moved per event before other connections get a turn
+    budget = 262144
+
+    def __init__(self, src, dst, counters, counter):
+        self.src = src.fileno()
+        self.dst = dst.fileno()
+        self.counters = counters
+        self.counter = counter
+        self.pipe = os.pipe()
+        self.pending = 0
+        self.finished = False
+        self.paused = False
+
+    def forward(self):
+        # returns True on EOF of src, False if src or dst would block or
+        # the budget is used up, which sets paused
+        flags = SPLICE_F_MOVE | SPLICE_F_NONBLOCK
+        moved = 0
+        self.paused = False
 
-        if is_ipv6:
-            sock = socket_builder(socket.AF_INET6, socket.SOCK_STREAM)
+        while True:
+            while self.pending > 0:
+                sent = libc_splice(self.pipe[0], None, self.dst, None, self.pending, flags)
+
+                if sent < 0:
+                    error = get_errno()
+                    if error == errno.EAGAIN:
+                        return False
+                    if error != errno.EINTR:
+                        raise WriterError(os.strerror(error))
+                    continue
+
+                self.pending -= sent
+
+            if self.finished:
+                return True
+
+            if moved >= self.budget:
+                self.paused = True
+                return False
+
+            # the pipe is empty here, so only src can make this block
+            received = libc_splice(self.src, None, self.pipe[1], None, self.chunk_size, flags)
+
+            if received > 0:
+                self.pending += received
+                moved += received
+                self.counters.add(self.counter, received)
+            elif received == 0:
+                self.finished = True
+            else:
+                error = get_errno()
+                if error == errno.EAGAIN:
+                    return False
+                if error != errno.EINTR:
+                    raise ReaderError(os.strerror(error))
+
+    def release_buffer(self):
+        if self.pipe is not None:
+            os.close(self.pipe[0])
+            os.close(self.pipe[1])
+            self.pipe = None
+
+class MITMConnection(object):
+    HANDSHAKING_WITH_CLIENT = 0
+    CONNECTING = 1
+    HANDSHAKING_WITH_SERVER = 2
+    READY = 3
+    FORWARDING = 4
+    CLOSED = 5
+
+    def __init__(self, request, client_address, server):
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.remote = None
+        self.remote_registered = False
+        self.upstream = None
+        self.downstream = None
+        self.upstream_finished = False
+        self.downstream_finished = False
+        self.said_bye_to_remote = False
+        self.said_bye_to_origin = False
+        self.resume_pending = False
+        self.bye_sent_to_remote = False
+        self.bye_sent_to_origin = False
+        self.setting_up = False
+        self.setup_again = False
+        self.setup_failed = False
+        self.state = self.HANDSHAKING_WITH_CLIENT
+
+        # the socket options are inherited from the listening socket
+        self.request.setblocking(False)
+
+        if self.server.config.transparent:
+            self.session = self.request
         else:
-            sock = socket_builder(socket.AF_INET, socket.SOCK_STREAM)
+            self.session = self.server.new_server_session(self.request)
+
+    def handle_event(self):
+        if self.state == self.FORWARDING:
+            self.forward()
+        elif self.state != self.CLOSED:
+            self.schedule_setup()
+
+    def schedule_setup(self):
+        # the handshakes are advanced by the workers one step at a time, so
+        # the crypto runs in parallel and the reactor never waits for it
+        if self.setting_up:
+            self.setup_again = True
+            return
+
+        self.setting_up = True
+        self.server.workers.submit(self.setup_step)
+
+    def setup_step(self):
+        # runs in a worker thread
+        try:
+            self.advance_setup()
+        except Exception:
+            self.server.handle_error(self.request, self.client_address)
+            self.server.counters.add("failed")
+            self.setup_failed = True
+
+        self.server.hand_over(self)
+
+    def advance_setup(self):
+        if self.state == self.HANDSHAKING_WITH_CLIENT and self.server.config.transparent:
+            # nothing to handshake, the records are passed through as they are
+            self.build_server_connection()
+            self.state = self.CONNECTING
+
+        if self.state == self.HANDSHAKING_WITH_CLIENT:
+            try:
+                self.session.handshake()
+            except (OperationWouldBlock, OperationInterrupted):
+                return
+
+            if self.server.config.verify_client_identity:
+                self.verify_client_identity()
+
+            if self.server.config.use_length_hiding_with_client and not self.session.can_use_length_hiding():
+                raise RuntimeError("Can't use length hiding with client")
+
+            self.remote = self.server.take_cached_upstream()
+
+            if self.remote is not None:
+                self.remote.setblocking(False)
+                self.server_handshake_done()
+                return
+
+            self.build_server_connection()
+            self.state = self.CONNECTING
+
+        if self.state == self.CONNECTING:
+            error = self.remote.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                raise socket.error(error, os.strerror(error))
+
+            try:
+                self.remote.getpeername()
+            except socket.error as e:
+                if e.args[0] == errno.ENOTCONN:
+                    return
+                raise
+
+            if self.server.config.transparent:
+                # the pipes are made here so that running out of fds only
+                # fails this connection
+                self.upstream = Splicer(self.request, self.remote, self.server.counters, "bytes_up")
+                self.downstream = Splicer(self.remote, self.request, self.server.counters, "bytes_down")
+                self.state = self.READY
+            else:
+                self.state = self.HANDSHAKING_WITH_SERVER
+
+        if self.state == self.HANDSHAKING_WITH_SERVER:
+            try:
+                self.remote.handshake()
+            except (OperationWouldBlock, OperationInterrupted):
+                return
 
-        if use_proxy:
-            proxy_type = socks.PROXY_TYPES[self.server.config.proxy[0]]
-            sock.set_proxy(proxy_type, *self.server.config.proxy[1:])
+            self.server_handshake_done()
 
-        self.remote = LengthHidingClientSession(sock, self.server.client_context, self.server.config.server_name_indicator)
+    def build_server_connection(self):
+        sock, server_address = self.server.create_server_socket()
 
-        if is_ipv6:
-            self.remote.connect((server_address[0][1:-1],) + server_address[1:])
+        if self.server.config.transparent:
+            self.remote = sock
         else:
+            self.remote = self.server.new_client_session(sock)
+
+        if self.server.use_proxy:
+            # talking to the proxy is blocking
             self.remote.connect(server_address)
+            self.remote.setblocking(False)
+            return
+
+        self.remote.setblocking(False)
+        error = self.remote.connect_ex(server_address)
+
+        if error not in (0, errno.EINPROGRESS):
+            raise socket.error(error, os.strerror(error))
+
+    def server_handshake_done(self):
+        if self.server.config.verify_server_identity:
+            self.verify_server_identity()
+
+        if self.server.config.use_length_hiding_with_server and not self.remote.can_use_length_hiding():
+            raise RuntimeError("Can't use length hiding with server")
 
-        self.remote.handshake()
+        self.state = self.READY
 
     def verify_client_identity(self):
         self.session.verify_peer()
@@ -182,51 +875,220 @@ class MITMHandler(SocketServer.BaseRequestHandler):
         self.remote.verify_peer()
         self.server.config.credentials_as_client.check_certificate(self.remote.peer_certificate)
 
-    def start_forwarding_thread(self):
-        self.forwarding_thread = ForwardingThread(self.remote, self.session, self.server)
-        self.forwarding_thread.start()
+    def setup_stepped(self):
+        # back on the reactor after a worker ran setup_step
+        self.setting_up = False
 
-    def handle(self):
-        reader = connection_reader(self.session, self.server.config.buffer_size)
+        if self.setup_failed:
+            self.close()
+            return
 
-        try:
-            if self.server.config.use_length_hiding_with_server:
-                forward_connection_with_padding(reader, self.remote, *self.server.config.padding_range_with_server)
-            else:
-                forward_connection(reader, self.remote)
-        except ReaderError:
-            self.say_bye_to_remote()
-            self.close_remote()
-            raise
-        except WriterError:
-            self.close_remote()
-            self.say_bye_to_origin()
-            raise
+        if self.remote is not None and not self.remote_registered:
+            self.remote_registered = True
+            self.server.add_fd(self.remote.fileno(), self)
+
+        if self.state == self.READY:
+            self.start_forwarding()
+        elif self.setup_again:
+            self.setup_again = False
+            self.schedule_setup()
+
+    def start_forwarding(self):
+        # in transparent mode the splicers were made by advance_setup
+        if not self.server.config.transparent:
+            self.create_forwarders()
+
+        # quickack does nothing on a listening or unconnected socket, so it
+        # is only set once both sides are connected
+        if self.server.config.tcp_quickack:
+            self.server.set_quickack(self.request)
+            self.server.set_quickack(self.remote)
+
+        self.state = self.FORWARDING
+        self.server.counters.add("established")
+
+        # both sides may have become readable while we were connecting
+        self.forward()
+
+    def create_forwarders(self):
+        config = self.server.config
+        buffer_pool = self.server.buffer_pool
+        counters = self.server.counters
+
+        if config.use_length_hiding_with_server:
+            self.remote.enable_write_queue()
+            self.upstream = Forwarder(self.session, self.remote, buffer_pool, counters, "bytes_up",
+                                      config.padding_range_with_server, config.coalesce_size)
+        else:
+            self.upstream = Forwarder(self.session, self.remote, buffer_pool, counters, "bytes_up",
+                                      None, config.coalesce_size)
+
+        if config.use_length_hiding_with_client:
+            self.session.enable_write_queue()
+            self.downstream = Forwarder(self.remote, self.session, buffer_pool, counters, "bytes_down",
+                                        config.padding_range_with_client, config.coalesce_size)
         else:
+            self.downstream = Forwarder(self.remote, self.session, buffer_pool, counters, "bytes_down",
+                                        None, config.coalesce_size)
+
+    def forward(self):
+        # a direction is half-closed once its source reached EOF, and we
+        # only tear the connection down when both directions are done
+        if not self.upstream_finished:
+            try:
+                self.upstream_finished = self.upstream.forward()
+            except ReaderError:
+                self.say_bye_to_remote()
+                self.server.handle_error(self.request, self.client_address)
+                self.close()
+                return
+            except WriterError:
+                self.say_bye_to_origin()
+                self.server.handle_error(self.request, self.client_address)
+                self.close()
+                return
+
+        # a bye that would have blocked is picked up again on a later event
+        if self.upstream_finished:
             self.say_bye_to_remote()
-            self.close_remote()
+
+        if not self.downstream_finished:
+            try:
+                self.downstream_finished = self.downstream.forward()
+            except ReaderError:
+                self.say_bye_to_origin()
+                self.server.handle_error(self.request, self.client_address)
+                self.close()
+                return
+            except WriterError:
+                self.say_bye_to_remote()
+                self.server.handle_error(self.request, self.client_address)
+                self.close()
+                return
+
+        if self.downstream_finished:
             self.say_bye_to_origin()
 
+        # the connection stays open until both close_notify alerts are out
+        if self.said_bye_to_remote and self.said_bye_to_origin:
+            self.close()
+            return
+
+        # the kernel drops out of quickack mode on its own, so it has to be
+        # re-armed after the reads to keep delayed ACKs off, the splicers of
+        # transparent mode keep the setting from start_forwarding only
+        if self.server.config.tcp_quickack and not self.server.config.transparent:
+            self.server.set_quickack(self.request)
+            self.server.set_quickack(self.remote)
+
+        # a direction that used up its budget is carried on by the reactor
+        if (self.upstream.paused or self.downstream.paused) and not self.resume_pending:
+            self.resume_pending = True
+            self.server.paused_connections.append(self)
+
     def say_bye_to_remote(self):
+        if self.said_bye_to_remote:
+            return
+
         try:
-            self.remote.bye()
+            if not self.server.config.transparent:
+                # gnutls_bye carries on where it stopped when called again
+                if not self.bye_sent_to_remote:
+                    self.remote.bye(SHUT_WR)
+                    self.bye_sent_to_remote = True
+
+                # with length hiding the alert may still sit in the write queue
+                if self.server.config.use_length_hiding_with_server and not self.remote.flush_write_queue():
+                    return
+
+            # the peer sees EOF even if it ignores the close_notify
+            self.remote.shutdown(socket.SHUT_WR)
+        except (OperationWouldBlock, OperationInterrupted):
+            return
         except:
             pass
 
+        self.said_bye_to_remote = True
+
     def close_remote(self):
+        self.server.remove_fd(self.remote.fileno())
+
+        if self.server.config.use_length_hiding_with_server and self.upstream is not None:
+            try:
+                self.remote.flush_write_queue()
+            except:
+                pass
+
         try:
-            self.remote.shutdown()
+            self.remote.shutdown(socket.SHUT_RDWR)
         except:
             pass
 
         self.remote.close()
 
+        if not self.server.config.transparent:
+            self.server.client_sessions.append(self.remote)
+
     def say_bye_to_origin(self):
+        if self.said_bye_to_origin:
+            return
+
         try:
-            self.session.bye()
+            if not self.server.config.transparent:
+                # gnutls_bye carries on where it stopped when called again
+                if not self.bye_sent_to_origin:
+                    self.session.bye(SHUT_WR)
+                    self.bye_sent_to_origin = True
+
+                # with length hiding the alert may still sit in the write queue
+                if self.server.config.use_length_hiding_with_client and not self.session.flush_write_queue():
+                    return
+
+            # the peer sees EOF even if it ignores the close_notify
+            self.session.shutdown(socket.SHUT_WR)
+        except (OperationWouldBlock, OperationInterrupted):
+            return
         except:
             pass
 
+        self.said_bye_to_origin = True
+
+    def close_origin(self):
+        self.server.remove_fd(self.request.fileno())
+
+        if self.server.config.use_length_hiding_with_client and self.downstream is not None:
+            try:
+                self.session.flush_write_queue()
+            except:
+                pass
+
+        try:
+            self.session.shutdown(socket.SHUT_RDWR)
+        except:
+            pass
+
+        self.session.close()
+
+        if not self.server.config.transparent:
+            self.server.server_sessions.append(self.session)
+
+    def close(self):
+        if self.state == self.CLOSED:
+            return
+
+        if self.remote is not None:
+            self.close_remote()
+
+        self.close_origin()
+        self.state = self.CLOSED
+
+        # either may be missing if the setup failed halfway
+        if self.upstream is not None:
+            self.upstream.release_buffer()
+
+        if self.downstream is not None:
+            self.downstream.release_buffer()
+
 class MITMSettings():
     def __init__(self, server_addr, listen_addr):
         self.server_address = server_addr
@@ -237,17 +1099,73 @@ if __name__ == '__main__':
 
     servers = []
     threads = []
+    children = []
+
+    PR_SET_PDEATHSIG = 1
 
-    def sigint_received(signum, frame):
+    def stop_received(signum, frame):
         for server in servers:
             server.shutdown()
 
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
         sys.exit(0)
 
+    def child_exited(signum, frame):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return
+
+            if pid == 0:
+                return
+
+            if pid in children:
+                children.remove(pid)
+                print("Process {} exited with status {}".format(pid, status))
+
+    configs = []
+
     for key, setting in settings.items():
         config = MITMSettings(setting["server_address"], setting["listen_address"])
         config.__dict__.update(default_settings)
         config.__dict__.update(setting)
+        configs.append((key, config))
+
+    # fork before any server starts its threads, process i serves the
+    # instances which ask for more than i processes
+    process_index = 0
+    parent = os.getpid()
+
+    for index in range(1, max([config.processes for _, config in configs] or [1])):
+        pid = os.fork()
+
+        if pid == 0:
+            process_index = index
+            children = []
+
+            # go down with the parent however it dies
+            libc.prctl(PR_SET_PDEATHSIG, signal.SIGTERM, 0, 0, 0)
+            if os.getppid() != parent:
+                os._exit(0)
+            break
+
+        children.append(pid)
+
+    if children:
+        signal.signal(signal.SIGCHLD, child_exited)
+        # don't let reaping interrupt the system calls of the other threads
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+    for key, config in configs:
+        if process_index >= config.processes:
+            continue
 
         try:
             server = MITMServer(config)
@@ -257,8 +1175,9 @@ if __name__ == '__main__':
             print("\n")
             continue
         else:
-            print("Starting listener \"{}\" on {} which forwards to {}".format(
-                key, config.listen_address, config.server_address))
+            if process_index == 0:
+                print("Starting listener \"{}\" on {} which forwards to {} in {} process(es)".format(
+                    key, config.listen_address, config.server_address, config.processes))
 
         thread = threading.Thread(target=server.serve_forever)
         thread.daemon = True
@@ -272,7 +1191,8 @@ if __name__ == '__main__':
         print("No proxy instance started, quitting.")
         sys.exit(1)
 
-    signal.signal(signal.SIGINT, sigint_received)
+    signal.signal(signal.SIGINT, stop_received)
+    signal.signal(signal.SIGTERM, stop_received)
 
     try:
         while True: